@@ -3,61 +3,98 @@
 from __future__ import annotations
 
 import argparse
-from concurrent.futures import as_completed, ThreadPoolExecutor
 import os
 from pathlib import Path
-import pty
+import queue
 import re
+import resource
 import select
 import shlex
 import signal
-import subprocess
 import sys
 import threading
-from typing import Optional
+from typing import Callable, Iterator, Optional, Union
 
 
-die = threading.Event()
-
 if sys.version_info <= (3, 9):
     print("ERROR: Requires Python 3.9 or higher", file=sys.stderr)
     raise SystemExit(1)
 
 
 def is_git_repo(d: Path):
-    cmd = ["git", "-C", str(d), "rev-parse"]
-    p = subprocess.run(cmd,
-                       stderr=subprocess.DEVNULL,
-                       stdout=subprocess.DEVNULL)
-    return p.returncode == 0
+    # A repo is marked by a .git entry (directory, or gitfile for
+    # worktrees/submodules); bare repos have HEAD plus objects/ at the
+    # top level.  Checking that directly is a stat instead of a git
+    # fork+exec.  HEAD alone is not enough: any stray file of that name
+    # would otherwise turn its directory into a "repo".
+    return (d / ".git").exists() or \
+        ((d / "HEAD").is_file() and (d / "objects").is_dir())
 
 
-def find_git_repos(parent: Path, depth: int = 3) -> list[Path]:
+def find_git_repos(parent: Path, depth: int = 3,
+                   exclude: Optional[re.Pattern] = None) -> list[Path]:
     assert parent.is_dir(), f"{parent} is not a directory"
     if is_git_repo(parent):
+        # The early return must honour exclusion too, same as any
+        # directory tested during descent
+        if exclude and exclude.search(str(parent)):
+            return []
         return [parent]
 
     if depth < 1:
         return []
 
+    # Explicit shared queue of directories to scan, worked by a small
+    # thread pool.  Workers never descend into a directory identified as
+    # a repo, so .git/objects, vendored checkouts etc. are not walked.
     repos: list[Path] = []
-    with ThreadPoolExecutor() as ex:
-        futures_repo_map = {ex.submit(is_git_repo, d): (d, depth - 1)
-                            for d in parent.iterdir()
-                            if d.is_dir()}
-
-        while futures_repo_map:
-            for future in as_completed(list(futures_repo_map)):
-                is_repo = future.result()
-                directory, cur_depth = futures_repo_map.pop(future)
-                if is_repo:
-                    repos.append(directory)
-                elif cur_depth > 0:
-                    futures_repo_map.update({
-                        ex.submit(is_git_repo, d): (d, cur_depth - 1)
-                        for d in directory.iterdir()
-                        if d.is_dir()
-                    })
+    lock = threading.Lock()
+    work: queue.SimpleQueue = queue.SimpleQueue()
+    work.put((parent, depth))
+    pending = 1
+    num_workers = min(32, (os.cpu_count() or 1) + 4)
+
+    def scan():
+        nonlocal pending
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            directory, cur_depth = item
+
+            found: list[Path] = []
+            descend: list[tuple[Path, int]] = []
+            try:
+                for entry in os.scandir(directory):
+                    if not entry.is_dir():
+                        continue
+                    # Excluded subtrees are pruned here, before descent,
+                    # not filtered from the result afterwards
+                    if exclude and exclude.search(entry.path):
+                        continue
+                    child = Path(entry.path)
+                    if is_git_repo(child):
+                        found.append(child)
+                    elif cur_depth > 1:
+                        descend.append((child, cur_depth - 1))
+            except OSError:  # e.g. permission denied; skip the directory
+                pass
+
+            with lock:
+                repos.extend(found)
+                pending += len(descend) - 1
+                done = pending == 0
+            for item in descend:
+                work.put(item)
+            if done:
+                for _ in range(num_workers):
+                    work.put(None)
+
+    workers = [threading.Thread(target=scan) for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
     return repos
 
 
@@ -96,8 +133,7 @@ def grep_command(args, git_args):
 
     # @Robustness: Maybe inserting at the start isn't always correct
     if args.use_defaults:
-        for idx, arg in enumerate(DEFAULT_GIT_GREP_ARGS):
-            git_args.insert(idx, arg)
+        git_args[:0] = DEFAULT_GIT_GREP_ARGS
 
     if args.exclude:
         git_excludes = [f":!{x}" for x in args.exclude]
@@ -108,9 +144,13 @@ def grep_command(args, git_args):
 
     print(f"=> git grep {shlex.join(git_args)}", file=sys.stderr)
 
+    # Without a prefix there is nothing to add per line, so the children
+    # can write to our stdout themselves -- no pipe, no copies
+    passthrough_fd = sys.stdout.fileno() if args.prefix == "no" else None
+
     def command(repo: Path):
-        return run_git(["git", "--no-pager", "-C", str(repo), "grep", *git_args],
-                       ignore_returncodes=(1,))
+        return spawn_git(["git", "--no-pager", "-C", str(repo), "grep", *git_args],
+                         ignore_returncodes=(1,), stdout_fd=passthrough_fd)
     return command
 
 
@@ -118,55 +158,231 @@ def grep_command(args, git_args):
 def default_command(args, git_args):
     print(f"=> git {shlex.join(git_args)}", file=sys.stderr)
 
+    passthrough_fd = sys.stdout.fileno() if args.prefix == "no" else None
+
     def command(repo: Path):
-        return run_git(["git", "--no-pager", "-C", str(repo), *git_args])
+        return spawn_git(["git", "--no-pager", "-C", str(repo), *git_args],
+                         stdout_fd=passthrough_fd)
     return command
 
 
-def run_git(command: list[str], *,
-            ok_returncodes: tuple[int] = (0,),
-            ignore_returncodes: tuple[int] = ()) -> Optional[tuple[list[bytes], list[bytes]]]:
-
-    masters, slaves = zip(*(pty.openpty() for _ in range(3)))
+class GitChild:
+    # A spawned git process; its output is drained by reap_children and
+    # collected into the stdout/stderr bytearrays until finish() is called.
+
+    def __init__(self, pid: int, stdout_fd: Optional[int], stderr_fd: int, *,
+                 ok_returncodes: tuple[int] = (0,),
+                 ignore_returncodes: tuple[int] = ()):
+        self.pid = pid
+        self.returncode: Optional[int] = None
+        self.stdout_fd: Optional[int] = stdout_fd
+        self.stderr_fd: Optional[int] = stderr_fd
+        self.stdout = bytearray()
+        self.stderr = bytearray()
+        self.ok_returncodes = ok_returncodes
+        self.ignore_returncodes = ignore_returncodes
+        # When set, complete stdout lines are passed here by reap_children
+        # as they arrive instead of accumulating until finish()
+        self.emit: Optional[Callable[[bytes], None]] = None
+
+    def wait(self) -> int:
+        if self.returncode is None:
+            _, status = os.waitpid(self.pid, 0)
+            self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def finish(self) -> Optional[tuple[list[bytes], list[bytes]]]:
+        returncode = self.wait()
+        self.close()
+
+        if returncode in self.ok_returncodes:
+            return (self.stdout.splitlines(keepends=True),
+                    self.stderr.splitlines(keepends=True))
+        elif returncode in self.ignore_returncodes:
+            return None
+        else:
+            raise GitError(self.stderr.decode())
+
+    def cancel(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except ProcessLookupError:  # already exited, just not reaped
+                pass
+            self.wait()
+        self.close()
+
+    def close(self):
+        for fd in (self.stdout_fd, self.stderr_fd):
+            if fd is not None:
+                os.close(fd)
+        self.stdout_fd = self.stderr_fd = None
+
+
+def spawn_git(command: list[str], *,
+              ok_returncodes: tuple[int] = (0,),
+              ignore_returncodes: tuple[int] = (),
+              stdout_fd: Optional[int] = None) -> GitChild:
+    # posix_spawnp instead of subprocess.Popen: no page-table copy for the
+    # parent (vfork semantics), which adds up when launching hundreds of
+    # gits.  /dev/null is opened as stdin inside the child, and the pipe
+    # fds are non-inheritable so only the dup2'd ends leak into the child.
+    # With stdout_fd the child writes there directly and no stdout pipe
+    # exists at all -- zero copies through this process.
+    stderr_read, stderr_write = os.pipe()
+    if stdout_fd is None:
+        stdout_read, stdout_write = os.pipe()
+        stdout_target = stdout_write
+    else:
+        stdout_read = None
+        stdout_target = stdout_fd
 
-    p = subprocess.Popen(command, close_fds=True, env={"TERM": os.getenv("TERM", "xterm")},
-                         stdin=slaves[0], stdout=slaves[1], stderr=slaves[2])
-    for fd in slaves:
-        os.close(fd)
+    try:
+        pid = os.posix_spawnp(command[0], command, os.environ, file_actions=[
+            (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0o666),
+            (os.POSIX_SPAWN_DUP2, stdout_target, 1),
+            (os.POSIX_SPAWN_DUP2, stderr_write, 2),
+        ])
+    except OSError:
+        if stdout_read is not None:
+            os.close(stdout_read)
+        os.close(stderr_read)
+        raise
+    finally:
+        if stdout_read is not None:
+            os.close(stdout_write)
+        os.close(stderr_write)
+
+    if stdout_read is not None:
+        os.set_blocking(stdout_read, False)
+    os.set_blocking(stderr_read, False)
+
+    return GitChild(pid, stdout_read, stderr_read,
+                    ok_returncodes=ok_returncodes,
+                    ignore_returncodes=ignore_returncodes)
+
+
+# Size of each read from a child; one select round-trip can move a full
+# pipe buffer instead of the 512 bytes os.read used to be asked for.
+READ_BUF_SIZE = 64 * 1024
+
+
+def reap_children(spawn_next: Callable[[], Optional[GitChild]],
+                  max_children: int) -> Iterator[GitChild]:
+    # Drain the output of every child on one epoll loop, yielding each
+    # child as both of its pipes hit EOF (i.e. in completion order).
+    # spawn_next is called to start another child whenever one finishes,
+    # keeping at most max_children in flight.
+    owners: dict[int, GitChild] = {}
+    accumulators: dict[int, bytearray] = {}
+    open_fds: dict[GitChild, int] = {}
+    epoll = select.epoll()
+
+    def register(child: GitChild):
+        count = 0
+        for fd, accumulator in ((child.stdout_fd, child.stdout),
+                                (child.stderr_fd, child.stderr)):
+            if fd is None:  # stdout passed straight through, no pipe
+                continue
+            owners[fd] = child
+            accumulators[fd] = accumulator
+            epoll.register(fd, select.EPOLLIN | select.EPOLLET)
+            count += 1
+        open_fds[child] = count
+
+    # One reader loop means one reusable scratch buffer; os.readv fills it
+    # in place instead of allocating a fresh bytes object per read.
+    scratch = memoryview(bytearray(READ_BUF_SIZE))
 
-    results = {
-        masters[1]: bytearray(),
-        masters[2]: bytearray(),
-    }
-    readable = [masters[1], masters[2]]
     try:
-        while readable:
-            if die.is_set():
-                p.send_signal(signal.SIGINT)
-                return None
-
-            ready, _, _ = select.select(readable, [], [])
-            for fd in ready:
-                data = os.read(fd, 512)
-                if not data:
-                    readable.remove(fd)
-                    continue
-                results[fd] += data
+        while len(open_fds) < max_children:
+            child = spawn_next()
+            if child is None:
+                break
+            register(child)
+
+        while owners:
+            for fd, _events in epoll.poll():
+                child = owners[fd]
+                accumulator = accumulators[fd]
+                # Edge-triggered: drain until the pipe would block
+                eof = False
+                while True:
+                    try:
+                        n = os.readv(fd, [scratch])
+                    except BlockingIOError:
+                        break
+                    if n == 0:
+                        eof = True
+                        break
+                    accumulator += scratch[:n]
+
+                if child.emit is not None and fd == child.stdout_fd:
+                    # Stream out what we have: everything up to the last
+                    # newline, or the unterminated remainder at EOF
+                    end = len(accumulator) if eof else accumulator.rfind(b"\n") + 1
+                    if end:
+                        child.emit(bytes(accumulator[:end]))
+                        del accumulator[:end]
+
+                if eof:
+                    epoll.unregister(fd)
+                    del owners[fd]
+                    del accumulators[fd]
+                    open_fds[child] -= 1
+                    if open_fds[child] == 0:
+                        del open_fds[child]
+                        yield child
+                        replacement = spawn_next()
+                        if replacement is not None:
+                            register(replacement)
     finally:
-        if p.poll() is None:
-            p.kill()
-        p.wait()
-        for fd in masters:
-            os.close(fd)
+        epoll.close()
 
-    stdout, stderr = results[masters[1]], results[masters[2]]
 
-    if p.returncode in ok_returncodes:
-        return stdout.splitlines(keepends=True), stderr.splitlines(keepends=True)
-    elif p.returncode in ignore_returncodes:
+def make_emitter(repo_prefix: bytes) -> Callable[[bytes], None]:
+    # Streamed lines bypass the BufferedWriter and go straight to the fd;
+    # each batch of complete lines is prefixed and shipped as one write
+    fd = sys.stdout.fileno()
+
+    def emit(chunk: bytes):
+        try:
+            os.write(fd, repo_prefix + repo_prefix.join(chunk.splitlines(keepends=True)))
+        except BrokenPipeError:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, fd)
+            raise SystemExit(1)
+    return emit
+
+
+class PatternUnion:
+    # Fallback with the same search() shape as re.Pattern for sets that
+    # cannot be folded into one expression
+
+    def __init__(self, patterns: list[re.Pattern]):
+        self.patterns = patterns
+
+    def search(self, s: str) -> Optional[re.Match]:
+        for pattern in self.patterns:
+            match = pattern.search(s)
+            if match:
+                return match
         return None
-    else:
-        raise GitError(stderr.decode())
+
+
+def union_regex(patterns: list[re.Pattern]) -> Optional[Union[re.Pattern, PatternUnion]]:
+    # Fold a pattern set into one alternation so each candidate string
+    # costs a single C-level search instead of a Python loop
+    if not patterns:
+        return None
+    if len(patterns) == 1:
+        return patterns[0]
+    try:
+        return re.compile("|".join(f"(?:{p.pattern})" for p in patterns))
+    except re.error:
+        # Individually valid patterns can still break the union (inline
+        # flags like (?i), duplicate group names); match them one by one
+        return PatternUnion(patterns)
 
 
 def re_argparse_type(s: str) -> re.Pattern:
@@ -208,15 +424,12 @@ def main() -> int:
         args.cwd = args.cwd.absolute()
     args.cwd = args.cwd.resolve()
 
-    include_patterns = args.include_patterns
-    exclude_patterns = args.exclude_patterns
+    include_pattern = union_regex(args.include_patterns)
+    exclude_pattern = union_regex(args.exclude_patterns)
 
     repos = []
-    for repo in find_git_repos(args.cwd, args.depth):
-        repo_str = str(repo)
-        if include_patterns and not any(pattern.search(repo_str) for pattern in include_patterns):
-            continue
-        if any(pattern.search(repo_str) for pattern in exclude_patterns):
+    for repo in find_git_repos(args.cwd, args.depth, exclude=exclude_pattern):
+        if include_pattern and not include_pattern.search(str(repo)):
             continue
         repos.append(repo)
 
@@ -244,51 +457,87 @@ def main() -> int:
 
     git_command = args.func(args, git_args)
 
-    try:
-        with ThreadPoolExecutor() as ex:
-            future_to_repo = {ex.submit(git_command, d): d for d in repos}
-
-            for future in as_completed(future_to_repo):
-                repo = future_to_repo[future]
-                try:
-                    results = future.result()
-                except GitError as e:
-                    print(f"ERROR: in repo {repo}:\n{e}", file=sys.stderr)
-                    # cancel futures
-                    die.set()
-                    for f in future_to_repo:
-                        f.cancel()
-                    return 1
-
-                if results is None:
-                    continue
-
-                repo_path = repo.relative_to(args.cwd)
-
-                if args.use_color:
-                    repo_prefix = f"{COLOR_GREEN}{repo_path!s}{COLOR_RESET}/".encode()
-                else:
-                    repo_prefix = f"{repo_path!s}/".encode()
+    prefix = args.prefix or "repo"
 
-                prefix = args.prefix or "repo"
-                if prefix == "repo":
-                    sys.stdout.buffer.write(repo_prefix + b"\n")
+    # Resolved once: every repo prefix is rendered through the same
+    # template against the same base directory
+    cwd = args.cwd
+    if args.use_color:
+        prefix_format = f"{COLOR_GREEN}{{}}{COLOR_RESET}/"
+    else:
+        prefix_format = "{}/"
+
+    # Cap in-flight gits; spawning all repos at once would burn two fds
+    # and a pid per repo with no added parallelism to show for it.  Also
+    # stay well inside RLIMIT_NOFILE: each child needs fds here and gits
+    # open plenty of their own.
+    nofile_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    max_children = max(1, min((os.cpu_count() or 1) * 4, nofile_limit // 8))
+
+    pending_repos = iter(repos)
+    # Pick the per-line flavour once here instead of testing prefix on
+    # every line of every repo below
+    if prefix == "line":
+        def flush_lines(stream, repo_prefix: bytes, lines: list[bytes]):
+            # One blob per repo: the prefix lands after every newline,
+            # so joining on it prefixes each line
+            stream.buffer.write(repo_prefix + repo_prefix.join(lines))
+            stream.flush()
+    else:
+        def flush_lines(stream, repo_prefix: bytes, lines: list[bytes]):
+            stream.buffer.write(b"".join(lines))
+            stream.flush()
+
+    children: dict[GitChild, Path] = {}
+    prefixes: dict[GitChild, bytes] = {}
+
+    def spawn_next() -> Optional[GitChild]:
+        for d in pending_repos:
+            child = git_command(d)
+            repo_prefix = prefix_format.format(d.relative_to(cwd)).encode()
+
+            if prefix == "line":
+                # Matched lines stream out as soon as they are complete
+                # instead of buffering until the repo's git exits
+                child.emit = make_emitter(repo_prefix)
+
+            children[child] = d
+            prefixes[child] = repo_prefix
+            return child
+        return None
 
-                for output, stream in zip(results, (sys.stdout, sys.stderr)):
-                    try:
-                        for result in output:
-                            if prefix == "line":
-                                stream.buffer.write(repo_prefix)
-                            stream.buffer.write(result)
-                        stream.flush()
-                    except BrokenPipeError:
-                        devnull = os.open(os.devnull, os.O_WRONLY)
-                        os.dup2(devnull, stream.fileno())
-                        raise SystemExit(1)
+    try:
+        for child in reap_children(spawn_next, max_children):
+            repo = children.pop(child)
+            repo_prefix = prefixes.pop(child)
+            try:
+                results = child.finish()
+            except GitError as e:
+                print(f"ERROR: in repo {repo}:\n{e}", file=sys.stderr)
+                return 1
+
+            if results is None:
+                continue
+
+            if prefix == "repo":
+                sys.stdout.buffer.write(repo_prefix + b"\n")
+
+            for output, stream in zip(results, (sys.stdout, sys.stderr)):
+                if not output:
+                    continue
+                try:
+                    flush_lines(stream, repo_prefix, output)
+                except BrokenPipeError:
+                    devnull = os.open(os.devnull, os.O_WRONLY)
+                    os.dup2(devnull, stream.fileno())
+                    raise SystemExit(1)
 
     except KeyboardInterrupt:
         print("Caught Ctrl-C, exiting.", file=sys.stderr)
         return 2
+    finally:
+        for child in children:
+            child.cancel()
 
     return 0
 